@@ -0,0 +1,63 @@
+import os
+import socket
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+# Receive buffer requested for each GCS socket; large enough to cover the bandwidth-delay product.
+SOCKET_RCVBUF = 16 * 1024 * 1024
+
+def parse_gcs_path(gcs_path):
+    """Parses a GCS path into bucket name and prefix."""
+    if not gcs_path.startswith("gs://"):
+        raise ValueError(f"Invalid GCS path: {gcs_path}")
+
+    bucket_name, _, prefix = gcs_path[len("gs://"):].partition('/')
+    return bucket_name, prefix
+
+def get_socket_options():
+    """Returns the socket options for GCS connections: no Nagle, plus a large receive buffer if allowed.
+
+    The kernel caps SO_RCVBUF at net.core.rmem_max, and setting it disables receive
+    buffer autotuning, so it is only requested when rmem_max can actually honour it.
+    """
+    # urllib3's defaults already set TCP_NODELAY
+    options = list(HTTPConnection.default_socket_options)
+    try:
+        with open('/proc/sys/net/core/rmem_max') as f:
+            rmem_max = int(f.read())
+    except OSError:
+        rmem_max = 0
+    if rmem_max >= SOCKET_RCVBUF:
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF))
+    return options
+
+SOCKET_OPTIONS = get_socket_options()
+
+def apply_socket_options():
+    """Makes every requests connection pool in this process use SOCKET_OPTIONS.
+
+    The patch goes on HTTPAdapter itself rather than on one session, so every
+    client and adapter created afterwards gets it. Reassigning
+    HTTPConnection.default_socket_options would do nothing, because urllib3 binds
+    it as a default argument.
+    """
+    init_poolmanager = HTTPAdapter.init_poolmanager
+    if getattr(init_poolmanager, 'socket_options_applied', False):
+        return
+
+    def tuned_init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', SOCKET_OPTIONS)
+        init_poolmanager(self, *args, **kwargs)
+
+    tuned_init_poolmanager.socket_options_applied = True
+    HTTPAdapter.init_poolmanager = tuned_init_poolmanager
+
+def drop_page_cache(fd):
+    """Tells the kernel a downloaded file will not be read back, so its pages can leave the page cache.
+
+    DONTNEED skips dirty pages, so the file is flushed to disk first; the write
+    then completes at disk speed instead of being absorbed by the page cache.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
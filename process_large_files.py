@@ -1,58 +1,113 @@
 
 import os
-import subprocess
-from urllib.parse import urlparse
+import base64
 import concurrent.futures
+import google_crc32c
+from google.cloud.storage import transfer_manager
 from tqdm import tqdm
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from gcs_utils import parse_gcs_path, apply_socket_options, drop_page_cache
 
-def parse_gcs_path(gcs_path):
-    """Parses a GCS path into bucket name and prefix."""
-    if not gcs_path.startswith("gs://"):
-        raise ValueError(f"Invalid GCS path: {gcs_path}")
-    
-    parsed_url = urlparse(gcs_path)
-    bucket_name = parsed_url.netloc
-    prefix = parsed_url.path.lstrip('/')
-    
-    return bucket_name, prefix
+# Files below this size are fetched as a single stream; sliced download only pays off above it.
+SLICED_DOWNLOAD_THRESHOLD = 128 * 1024 * 1024
 
-def list_blobs(gcs_path):
-    """Lists all the blobs in the bucket that begin with the prefix."""
-    command = ["gsutil", "ls", gcs_path]
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(f"Failed to list blobs: {result.stderr.strip()}")
-    blobs = result.stdout.splitlines()
-    return blobs
+# Suffix for sliced downloads in progress; the file is renamed once every slice has arrived.
+PARTIAL_SUFFIX = ".part"
 
-def download_blob(blob_url, destination_file_name, num_slices=8):
-    """Downloads a blob using gsutil with sliced download."""
-    command = [
-        "gsutil",
-        "-o", "GSUtil:parallel_thread_count=1",
-        "-o", f"GSUtil:sliced_object_download_max_components={num_slices}",
-        "cp",
-        blob_url,
-        destination_file_name
-    ]
-    print(f"Running command: {' '.join(command)}")  # Debugging output
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(f"Failed to download blob {blob_url}: {result.stderr.strip()}")
-
-def download_all_files(gcs_path, destination_folder, num_slices=8):
-    """Downloads all files from a GCS folder to a local directory."""
+# Applied at import so every client this script creates uses the tuned sockets
+apply_socket_options()
+
+def check_crc32c_implementation():
+    """Warns when CRC32C checksums fall back to the slow pure-Python implementation."""
+    if google_crc32c.implementation != "c":
+        print("Warning: google-crc32c C extension not found; checksum validation will be slow. "
+              "Install google-crc32c>=1.5 with a prebuilt wheel for this platform.")
+
+def list_blobs(gcs_path, max_connections=10):
+    """Lists all the blobs in the bucket that begin with the prefix.
+
+    The blobs share one client, so its connection pool is sized for every
+    slice thread that downloads through it at once.
+    """
+    bucket_name, prefix = parse_gcs_path(gcs_path)
+    client = storage.Client()
+    client._http.mount('https://', HTTPAdapter(pool_maxsize=max_connections))
+    bucket = client.bucket(bucket_name)
+    # Only request the metadata the downloads use
+    return list(bucket.list_blobs(prefix=prefix, fields="items(name,size,generation,crc32c),nextPageToken"))
+
+def file_crc32c(file_name):
+    """Returns the CRC32C of a local file, base64-encoded the way GCS reports it."""
+    checksum = google_crc32c.Checksum()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+def download_blob(blob, destination_file_name, num_slices=8):
+    """Downloads a blob, using concurrent byte-range slices for large blobs.
+
+    Blobs a previous run already downloaded in full are skipped, and interrupted
+    single-stream downloads resume from the end of the partial file. A resumed
+    file is checked against the blob's CRC32C, since ranged downloads are not
+    validated, and downloaded again in full if it does not match.
+    """
+    existing = os.path.exists(destination_file_name)
+    existing_size = os.path.getsize(destination_file_name) if existing else 0
+    if existing and existing_size == blob.size:
+        return
+
+    if blob.size < SLICED_DOWNLOAD_THRESHOLD:
+        if 0 < existing_size < blob.size:
+            with open(destination_file_name, 'ab') as dest_file:
+                blob.download_to_file(dest_file, start=existing_size)
+            # The prefix may come from an older generation of the object
+            if blob.crc32c is None or file_crc32c(destination_file_name) != blob.crc32c:
+                print(f"Checksum mismatch after resuming {blob.name}; downloading it again in full.")
+                blob.download_to_filename(destination_file_name)
+        else:
+            blob.download_to_filename(destination_file_name)
+    else:
+        # Slices complete out of order, so a partial file is not a resumable prefix.
+        # Download next to the destination and only move it into place once complete.
+        partial_file_name = destination_file_name + PARTIAL_SUFFIX
+        transfer_manager.download_chunks_concurrently(
+            blob,
+            partial_file_name,
+            chunk_size=32 * 1024 * 1024,
+            max_workers=num_slices,
+            # Threads, not processes: forking here while other downloads hold locks can
+            # deadlock, and threads reuse this client instead of re-authenticating per file
+            worker_type=transfer_manager.THREAD,
+        )
+        os.replace(partial_file_name, destination_file_name)
+    # The client library owns the write handle, so reopen the file to advise on it
+    with open(destination_file_name, 'rb') as dest_file:
+        drop_page_cache(dest_file.fileno())
+
+def download_all_files(gcs_path, destination_folder, parallel_files=4, max_workers=32):
+    """Downloads all files from a GCS folder to a local directory.
+
+    max_workers is the total number of slice workers across all files, so it is
+    divided between the files downloaded in parallel rather than multiplied by them.
+    """
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
 
-    blobs = list_blobs(gcs_path)
+    check_crc32c_implementation()
+    blobs = list_blobs(gcs_path, max_connections=max_workers)
     print(f"Found {len(blobs)} files to download.")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_slices) as executor:
+    # With fewer files than parallel slots, each file gets a larger share of the slices
+    parallel_files = max(1, min(parallel_files, len(blobs)))
+    num_slices = max(1, max_workers // parallel_files)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_files) as executor:
         futures = []
-        for blob_url in blobs:
-            destination_file_name = os.path.join(destination_folder, os.path.basename(blob_url))
-            futures.append(executor.submit(download_blob, blob_url, destination_file_name, num_slices))
+        for blob in blobs:
+            destination_file_name = os.path.join(destination_folder, os.path.basename(blob.name))
+            futures.append(executor.submit(download_blob, blob, destination_file_name, num_slices))
 
         # Progress bar
         for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Downloading files"):
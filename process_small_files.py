@@ -1,96 +1,112 @@
 import os
+import functools
+import threading
+import multiprocessing
 import gcsfs
 import concurrent.futures
 from tqdm import tqdm
-from urllib.parse import urlparse
-
-def parse_gcs_path(gcs_path):
-    """Parses a GCS path into bucket name and prefix."""
-    if not gcs_path.startswith("gs://"):
-        raise ValueError(f"Invalid GCS path: {gcs_path}")
-    
-    parsed_url = urlparse(gcs_path)
-    bucket_name = parsed_url.netloc
-    prefix = parsed_url.path.lstrip('/')
-    
-    return bucket_name, prefix
-
-def list_blobs(fs, bucket_name, prefix):
-    """Lists all the blobs in the bucket that begin with the prefix."""
-    return fs.ls(f"{bucket_name}/{prefix}")
-
-def get_blob_size(fs, blob_path):
-    """Get the size of a blob in bytes."""
-    return fs.info(blob_path)['size']
-
-def download_blob(fs, blob_path, destination_file_name):
-    """Downloads a blob using gcsfs with streaming."""
-    with fs.open(blob_path, 'rb') as source_file:
-        with open(destination_file_name, 'wb') as dest_file:
-            for chunk in iter(lambda: source_file.read(1024 * 1024), b""):
-                dest_file.write(chunk)
-
-def download_group(fs, bucket_name, blobs, destination_folder):
-    """Downloads a group of blobs to the destination folder."""
-    for blob in blobs:
-        relative_path = os.path.relpath(blob, start=f'{bucket_name}/')
-        destination_file_name = os.path.join(destination_folder, relative_path)
-        os.makedirs(os.path.dirname(destination_file_name), exist_ok=True)
-        download_blob(fs, blob, destination_file_name)
-
-def group_blobs_by_size(fs, blobs, max_size_mb):
-    """Groups blobs into chunks where each chunk does not exceed max_size_mb."""
-    max_size_bytes = max_size_mb * 1024 * 1024
-    grouped_blobs = []
-    current_group = []
-    current_size = 0
-
-    for blob in blobs:
-        blob_size = get_blob_size(fs, blob)
-        if current_size + blob_size > max_size_bytes:
-            grouped_blobs.append(current_group)
-            current_group = []
-            current_size = 0
-        
-        current_group.append(blob)
-        current_size += blob_size
-
-    if current_group:
-        grouped_blobs.append(current_group)
-
-    return grouped_blobs
-
-def download_all_files(gcs_path, destination_folder, max_size_mb=100, num_threads=16):
-    """Downloads all files from a GCS folder to a local directory."""
+from google.cloud import storage
+from gcs_utils import parse_gcs_path, apply_socket_options, drop_page_cache
+
+# Blobs below this size are fetched in one request instead of a streamed, multi-chunk download.
+SINGLE_SHOT_THRESHOLD = 8 * 1024 * 1024
+
+_tls = threading.local()
+
+# Applied at import; forkserver workers re-import this module, so they get it too
+apply_socket_options()
+
+def _get_bucket(bucket_name):
+    """Returns this worker's bucket handle, creating the client on first use so its connections are reused."""
+    if not hasattr(_tls, 'client'):
+        _tls.client = storage.Client()
+    return _tls.client.bucket(bucket_name)
+
+def list_blobs_parallel(fs, bucket_name, prefix, max_workers=24):
+    """Lists all the blobs in the bucket that begin with the prefix, with their sizes.
+
+    The listing is sharded on the first-level subdirectories, which are listed
+    concurrently. Yields one list of blobs per shard as soon as it is ready.
+    """
+    entries = fs.ls(f"{bucket_name}/{prefix}", detail=True)
+    files = [entry for entry in entries if entry['type'] == 'file']
+    if files:
+        yield files
+
+    subdirs = [entry['name'] for entry in entries if entry['type'] == 'directory']
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fs.find, subdir, detail=True) for subdir in subdirs]
+        for future in concurrent.futures.as_completed(futures):
+            yield list(future.result().values())
+
+def download_blob(bucket_name, blob_name, blob_size, destination_file_name):
+    """Downloads a blob using google-cloud-storage, skipping it if a previous run already did."""
+    if os.path.exists(destination_file_name) and os.path.getsize(destination_file_name) == blob_size:
+        return
+
+    blob = _get_bucket(bucket_name).blob(blob_name)
+    with open(destination_file_name, 'wb') as dest_file:
+        blob.download_to_file(dest_file, single_shot_download=blob_size < SINGLE_SHOT_THRESHOLD)
+        dest_file.flush()
+        drop_page_cache(dest_file.fileno())
+
+def get_destination_file_name(bucket_name, blob_name, destination_folder):
+    """Maps a blob name to its path under the destination folder."""
+    relative_path = os.path.relpath(blob_name, start=f'{bucket_name}/')
+    return os.path.join(destination_folder, relative_path)
+
+def finish_download(future, pending, progress_bar):
+    """Reports a finished download and frees its slot for the next submission."""
+    pending.release()
+    progress_bar.update(1)
+    if future.exception() is not None:
+        print(f"Error downloading file: {future.exception()}")
+
+def download_all_files(gcs_path, destination_folder, num_workers=16):
+    """Downloads all files from a GCS folder to a local directory.
+
+    Each blob is submitted to the process pool as soon as it is listed. At most
+    num_workers * 4 downloads are pending at once, so listing stays only
+    slightly ahead of the downloads.
+    """
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
 
     bucket_name, prefix = parse_gcs_path(gcs_path)
     fs = gcsfs.GCSFileSystem()
-    blobs = list_blobs(fs, bucket_name, prefix)
-    print(f"Found {len(blobs)} files to download.")
-
-    grouped_blobs = group_blobs_by_size(fs, blobs, max_size_mb)
-    print(f"Grouped files into {len(grouped_blobs)} chunks.")
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        futures = []
-        for group in grouped_blobs:
-            futures.append(executor.submit(download_group, fs, bucket_name, group, destination_folder))
-
-        # Progress bar
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Downloading files"):
-            try:
-                future.result()
-            except Exception as e:
-                print(f"Error downloading files: {e}")
+    pending = threading.BoundedSemaphore(num_workers * 4)
+    # Workers start while listing threads and the gcsfs IO loop are running, so they must
+    # not be forked from this process: a lock held at fork time could deadlock the child
+    mp_context = multiprocessing.get_context("forkserver")
+    created_dirs = set()
+
+    # Progress bar total grows as files are discovered
+    with tqdm(total=0, unit="file", desc="Downloading files") as progress_bar, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as executor:
+        for blobs in list_blobs_parallel(fs, bucket_name, prefix):
+            progress_bar.total += len(blobs)
+            progress_bar.refresh()
+
+            for blob in blobs:
+                destination_file_name = get_destination_file_name(bucket_name, blob['name'], destination_folder)
+                # Create each directory once here so the workers only open and write files
+                dir_name = os.path.dirname(destination_file_name)
+                if dir_name not in created_dirs:
+                    os.makedirs(dir_name, exist_ok=True)
+                    created_dirs.add(dir_name)
+
+                # gcsfs names include the bucket; the storage client wants the object name alone
+                blob_name = blob['name'].partition('/')[2]
+                pending.acquire()
+                future = executor.submit(download_blob, bucket_name, blob_name, blob['size'], destination_file_name)
+                future.add_done_callback(functools.partial(finish_download, pending=pending, progress_bar=progress_bar))
 
 if __name__ == "__main__":
     gcs_path = "gs://ai-drive-psg-2024-us-central1/scenario_4_very_small_files"
     destination_folder = "/mnt/disks/local_disk_1"
 
     try:
-        download_all_files(gcs_path, destination_folder, max_size_mb=50, num_threads=16)  # Adjust num_threads as needed
+        download_all_files(gcs_path, destination_folder, num_workers=16)  # Adjust num_workers as needed
     except Exception as e:
         print(f"An error occurred: {e}")
 